@@ -11,28 +11,44 @@ Elba → Bitrix24 Контрагенты Sync (Companies & Contacts)
   BITRIX_WEBHOOK_URL=https://<your-domain>.bitrix24.ru/rest/1/WEBHOOK_CODE/
 
 Запуск:
-  python /workspace/sync_elba_counterparties.py
+  python /workspace/sync_elba_counterparties.py [--force-check-userfields]
+
+После первой успешной проверки пользовательских полей рядом со скриптом
+создаётся .elba_sync_state.json, и при следующих запусках с тем же порталом
+Bitrix24 проверка пропускается. --force-check-userfields выполняет её принудительно.
 
 Зависимости (requirements.txt):
-  requests
+  httpx[http2]
   python-dotenv
   tenacity
   tqdm
+
+Необязательно: orjson (pip install orjson) ускоряет разбор JSON; без него
+используется стандартный json.
 """
 import os
 import sys
+import json
+import asyncio
 import logging
-from typing import Dict, List, Any, Optional, Tuple
+import argparse
+from urllib.parse import urlencode, urlparse
+from typing import AsyncIterator, Awaitable, Dict, Iterable, Iterator, List, Any, Optional, Set, Tuple
 
-import requests
+import httpx
 from dotenv import load_dotenv
 from tenacity import (
-    retry,
+    AsyncRetrying,
     stop_after_attempt,
     wait_exponential,
     retry_if_exception_type,
 )
-from tqdm import tqdm
+from tqdm.asyncio import tqdm as atqdm
+
+try:
+    import orjson
+except ImportError:  # без orjson работаем на стандартном json
+    orjson = None  # type: ignore[assignment]
 
 # ------------------------- Конфигурация и логирование -------------------------
 load_dotenv()
@@ -54,10 +70,61 @@ logger = logging.getLogger(__name__)
 
 ELBA_API_BASE = "https://elba-api.kontur.ru/v1"
 
+# Локальное состояние между запусками (например, что пользовательские поля уже созданы)
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".elba_sync_state.json")
+
+# Известные варианты эндпоинтов Эльбы (в порядке предпочтения)
+COUNTERPARTY_ENDPOINTS = (
+    "{base}/organizations/{org_id}/counterparties",
+    "{base}/organizations/{org_id}/contractors",
+    "{base}/counterparties",
+    "{base}/contractors",
+)
+CONTACT_ENDPOINTS = (
+    "{base}/organizations/{org_id}/counterparties/{cp_id}/contacts",
+    "{base}/organizations/{org_id}/contractors/{cp_id}/contacts",
+    "{base}/counterparties/{cp_id}/contacts",
+    "{base}/contractors/{cp_id}/contacts",
+)
+COUNTERPARTY_ITEM_KEYS = ["items", "counterparties", "contractors"]
+CONTACT_ITEM_KEYS = ["items", "contacts"]
+# Ответы, по которым вариант эндпоинта считается несуществующим
+NOT_FOUND_STATUSES = (400, 404)
+
+# Сработавший шаблон эндпоинта по роли ("counterparties", "contacts"),
+# чтобы не перебирать варианты на каждом контрагенте. Запоминается только
+# вариант, реально вернувший данные (или единственный ответивший 200, когда
+# остальные для того же контрагента ответили 400/404).
+_ENDPOINT_CACHE: Dict[str, str] = {}
+# Сколько контрагентов одновременно пробуют варианты, пока эндпоинт не определён:
+# обычно первые же пробы всё решают, и остальным перебирать уже не нужно
+ENDPOINT_PROBE_CONCURRENCY = 4
+_ENDPOINT_PROBE_SEMAPHORES: Dict[str, asyncio.Semaphore] = {}
+
+# Скрипт упирается в сетевые задержки, поэтому запросы идут параллельно,
+# но не более HTTP_CONCURRENCY одновременно (чтобы не упереться в лимиты API)
+HTTP_CONCURRENCY = 20
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+# Пересоздаётся в начале каждого main() (см. reset_run_state): asyncio-примитивы
+# привязываются к циклу событий, в котором впервые использованы
+HTTP_SEMAPHORE = asyncio.Semaphore(HTTP_CONCURRENCY)
+
+# Максимальное число команд в одном запросе batch Bitrix24
+BITRIX_BATCH_SIZE = 50
+# Сколько раз пробуем запрос к Bitrix24 при сетевых ошибках и 5xx
+BITRIX_ATTEMPTS = 3
+# Сколько запросов crm.*.list для поиска существующих сущностей идут одновременно
+LOOKUP_CONCURRENCY = 10
+# Контрагенты из Эльбы идут через очередь к обработчикам, которые синхронизируют
+# их пачками по BITRIX_BATCH_SIZE, пока загружаются следующие страницы
+SYNC_QUEUE_SIZE = 200
+SYNC_WORKERS = 4
+
 # ------------------------------- Вспомогательные ------------------------------
 
-def chunked(iterable: List[Any], size: int) -> List[List[Any]]:
-    return [iterable[i : i + size] for i in range(0, len(iterable), size)]
+def chunked(iterable: List[Any], size: int) -> Iterator[List[Any]]:
+    for i in range(0, len(iterable), size):
+        yield iterable[i : i + size]
 
 
 def extract_name_parts(full_name: str) -> Tuple[str, str, str]:
@@ -70,17 +137,103 @@ def extract_name_parts(full_name: str) -> Tuple[str, str, str]:
     return last_name, first_name, second_name
 
 
+def flatten_params(value: Any, prefix: str = "") -> List[Tuple[str, str]]:
+    """Разворачивает вложенные dict/list в пары вида fields[PHONE][0][VALUE]=..."""
+    if isinstance(value, dict):
+        pairs: List[Tuple[str, str]] = []
+        for key, item in value.items():
+            pairs.extend(flatten_params(item, f"{prefix}[{key}]" if prefix else str(key)))
+        return pairs
+    if isinstance(value, list):
+        pairs = []
+        for index, item in enumerate(value):
+            pairs.extend(flatten_params(item, f"{prefix}[{index}]"))
+        return pairs
+    return [(prefix, str(value))]
+
+
+def json_dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False).encode("utf-8")
+
+
+def json_loads(raw: bytes) -> Any:
+    if not raw:
+        return None
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def load_state() -> Dict[str, Any]:
+    if not os.path.exists(STATE_FILE):
+        return {}
+    try:
+        with open(STATE_FILE, encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать {STATE_FILE}: {e}")
+        return {}
+
+
+def save_state(state: Dict[str, Any]) -> None:
+    try:
+        with open(STATE_FILE, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить {STATE_FILE}: {e}")
+
+
+def reset_run_state() -> None:
+    """Готовит модульное состояние к новому запуску в текущем цикле событий:
+    новый HTTP_SEMAPHORE, пустые кеши эндпоинтов и их семафоры."""
+    global HTTP_SEMAPHORE
+    HTTP_SEMAPHORE = asyncio.Semaphore(HTTP_CONCURRENCY)
+    _ENDPOINT_CACHE.clear()
+    _ENDPOINT_PROBE_SEMAPHORES.clear()
+
+
+def create_http_session(headers: Optional[Dict[str, str]] = None) -> httpx.AsyncClient:
+    """Клиент с пулом keep-alive соединений; заводится по одному на хост (Эльба, Bitrix24).
+
+    HTTP/2 позволяет вести параллельные запросы через одно TLS-соединение.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=HTTP_TIMEOUT,
+        headers=headers,
+    )
+
+
 # ----------------------------- Bitrix24 обертки -------------------------------
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type((requests.exceptions.RequestException,)),
-)
-def bitrix_call(method: str, params: Optional[Dict[str, Any]] = None) -> Any:
+
+async def bitrix_call(
+    session: httpx.AsyncClient,
+    method: str,
+    params: Optional[Dict[str, Any]] = None,
+    retry: bool = True,
+) -> Any:
+    """retry=False — для неидемпотентных вызовов: повтор после таймаута мог бы
+    выполнить их второй раз."""
     url = f"{BITRIX_WEBHOOK}{method}"
-    resp = requests.post(url, json=params or {}, timeout=(10, 60))
-    resp.raise_for_status()
-    data = resp.json()
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(BITRIX_ATTEMPTS if retry else 1),
+        wait=wait_exponential(multiplier=1, min=4, max=10),
+        retry=retry_if_exception_type((httpx.HTTPError,)),
+        reraise=True,
+    ):
+        with attempt:
+            async with HTTP_SEMAPHORE:
+                resp = await session.post(
+                    url,
+                    content=json_dumps(params or {}),
+                    headers={"Content-Type": "application/json"},
+                )
+                resp.raise_for_status()
+                data = json_loads(resp.content)
     if isinstance(data, dict) and "error" in data:
         raise RuntimeError(
             f"Bitrix24 API error {data.get('error')}: {data.get('error_description')}"
@@ -88,7 +241,30 @@ def bitrix_call(method: str, params: Optional[Dict[str, Any]] = None) -> Any:
     return data.get("result") if isinstance(data, dict) else data
 
 
-def create_bitrix_userfield(entity_type: str, field_name: str, label: str) -> Any:
+async def bitrix_batch(
+    session: httpx.AsyncClient, cmds: Dict[str, str], retry: bool = True
+) -> Dict[str, Any]:
+    """Выполняет до BITRIX_BATCH_SIZE команд за один запрос, возвращает мапу имя -> результат.
+
+    Команды с ошибками в результат не попадают (halt=0), ошибки пишутся в лог;
+    вызывающий код считает такие команды несозданными.
+    """
+    data = await bitrix_call(session, "batch", {"halt": 0, "cmd": cmds}, retry=retry) or {}
+    errors = data.get("result_error") or {}
+    if isinstance(errors, dict):
+        for name, error in errors.items():
+            logger.error(f"Bitrix24 batch: ошибка команды {name}: {error}")
+    results = data.get("result") or {}
+    return results if isinstance(results, dict) else {}
+
+
+def build_batch_command(method: str, params: Dict[str, Any]) -> str:
+    return f"{method}?{urlencode(flatten_params(params))}"
+
+
+async def create_bitrix_userfield(
+    session: httpx.AsyncClient, entity_type: str, field_name: str, label: str
+) -> Any:
     method = f"crm.{entity_type}.userfield.add"
     params = {
         "fields": {
@@ -99,37 +275,61 @@ def create_bitrix_userfield(entity_type: str, field_name: str, label: str) -> An
             "MANDATORY": "N",
         }
     }
-    return bitrix_call(method, params)
+    return await bitrix_call(session, method, params)
+
+
+def bitrix_portal() -> str:
+    """Хост портала Bitrix24 из BITRIX_WEBHOOK_URL."""
+    return urlparse(BITRIX_WEBHOOK or "").netloc.lower()
 
 
-def ensure_userfields() -> None:
+async def ensure_userfields(session: httpx.AsyncClient, force: bool = False) -> None:
+    # Пользовательские поля создаются один раз и не пропадают — если проверка
+    # уже проходила успешно, повторно в Bitrix24 не ходим
+    state = load_state()
+    # Запоминаем по порталу: на новом портале (другой BITRIX_WEBHOOK_URL) поля
+    # нужно проверить и создать заново. Сам вебхук с секретом не храним.
+    portal = bitrix_portal()
+    ready_portals = state.get("userfields_ready_portals")
+    if not isinstance(ready_portals, list):
+        ready_portals = []
+    if not force and portal in ready_portals:
+        logger.info(f"Пользовательские поля на {portal} уже проверены ранее, пропускаю")
+        return
+
     try:
-        contact_fields = bitrix_call(
-            "crm.contact.userfield.list", {"filter": {"FIELD_NAME": "UF_CRM_ELBA_ID"}}
+        contact_fields = await bitrix_call(
+            session, "crm.contact.userfield.list", {"filter": {"FIELD_NAME": "UF_CRM_ELBA_ID"}}
         ) or []
         if not any(f.get("FIELD_NAME") == "UF_CRM_ELBA_ID" for f in contact_fields):
-            uf_id = create_bitrix_userfield("contact", "UF_CRM_ELBA_ID", "ID Эльбы")
+            uf_id = await create_bitrix_userfield(session, "contact", "UF_CRM_ELBA_ID", "ID Эльбы")
             logger.info(f"Создано поле для контактов UF_CRM_ELBA_ID: {uf_id}")
 
-        company_fields = bitrix_call(
-            "crm.company.userfield.list", {"filter": {"FIELD_NAME": "UF_CRM_ELBA_ID"}}
+        company_fields = await bitrix_call(
+            session, "crm.company.userfield.list", {"filter": {"FIELD_NAME": "UF_CRM_ELBA_ID"}}
         ) or []
         if not any(f.get("FIELD_NAME") == "UF_CRM_ELBA_ID" for f in company_fields):
-            uf_id = create_bitrix_userfield("company", "UF_CRM_ELBA_ID", "ID Эльбы")
+            uf_id = await create_bitrix_userfield(session, "company", "UF_CRM_ELBA_ID", "ID Эльбы")
             logger.info(f"Создано поле для компаний UF_CRM_ELBA_ID: {uf_id}")
 
         # Необязательное поле для ИНН (если планируем записывать)
-        company_inn_fields = bitrix_call(
-            "crm.company.userfield.list", {"filter": {"FIELD_NAME": "UF_CRM_INN"}}
+        company_inn_fields = await bitrix_call(
+            session, "crm.company.userfield.list", {"filter": {"FIELD_NAME": "UF_CRM_INN"}}
         ) or []
         if not any(f.get("FIELD_NAME") == "UF_CRM_INN" for f in company_inn_fields):
-            uf_id = create_bitrix_userfield("company", "UF_CRM_INN", "ИНН")
+            uf_id = await create_bitrix_userfield(session, "company", "UF_CRM_INN", "ИНН")
             logger.info(f"Создано поле для компаний UF_CRM_INN: {uf_id}")
 
     except Exception as e:
         logger.error(f"Ошибка проверки/создания пользовательских полей: {e}")
         raise
 
+    if portal not in ready_portals:
+        ready_portals.append(portal)
+    state["userfields_ready_portals"] = ready_portals
+    state.pop("userfields_ready", None)  # прежний формат без привязки к порталу
+    save_state(state)
+
 
 # ------------------------------- Elba API -------------------------------------
 
@@ -140,16 +340,16 @@ def elba_headers() -> Dict[str, str]:
     }
 
 
-def get_organization_id() -> str:
-    try:
-        resp = requests.get(
-            f"{ELBA_API_BASE}/organizations",
-            headers=elba_headers(),
-            params={"limit": 1},
-            timeout=(10, 60),
-        )
+async def elba_get(session: httpx.AsyncClient, url: str, params: Dict[str, Any]) -> Any:
+    async with HTTP_SEMAPHORE:
+        resp = await session.get(url, params=params)
         resp.raise_for_status()
-        data = resp.json() or {}
+        return json_loads(resp.content)
+
+
+async def get_organization_id(session: httpx.AsyncClient) -> str:
+    try:
+        data = await elba_get(session, f"{ELBA_API_BASE}/organizations", {"limit": 1}) or {}
         orgs = data.get("organizations") or data.get("items") or []
         if not orgs:
             raise RuntimeError("Не найдена собственная организация (GET /organizations)")
@@ -159,88 +359,225 @@ def get_organization_id() -> str:
         raise
 
 
-def fetch_all_paginated(url: str, params: Dict[str, Any], item_keys: List[str]) -> List[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
+def extract_items(data: Any, item_keys: List[str]) -> List[Dict[str, Any]]:
+    # Попробуем разные ключи ответов
+    if isinstance(data, dict):
+        for key in item_keys:
+            if isinstance(data.get(key), list):
+                return data.get(key)  # type: ignore[return-value]
+    elif isinstance(data, list):
+        return data  # иногда может прийти массив напрямую
+    return []
+
+
+def extract_cursor(data: Any, cursor_keys: Tuple[str, ...]) -> Optional[str]:
+    if not isinstance(data, dict):
+        return None
+    for key in cursor_keys:
+        if data.get(key):
+            return str(data.get(key))
+    return None
+
+
+async def iter_paginated(
+    session: httpx.AsyncClient,
+    url: str,
+    params: Dict[str, Any],
+    item_keys: List[str],
+    cursor_keys: Tuple[str, ...] = ("nextCursor", "continuationToken", "cursor"),
+) -> AsyncIterator[Dict[str, Any]]:
+    """Отдаёт записи по мере загрузки страниц. Если сервер отдаёт курсор
+    следующей страницы, идём по нему; иначе — обычная пагинация skip/limit."""
+    total = 0
     skip = 0
     limit = int(params.get("limit", 100))
+    cursor: Optional[str] = None
+    # Определяется по первому ответу: есть курсор — пагинация по курсору
+    use_cursor: Optional[bool] = None
 
     while True:
         local_params = dict(params)
-        local_params.update({"skip": skip, "limit": limit})
+        if use_cursor:
+            local_params.update({"cursor": cursor, "limit": limit})
+        else:
+            local_params.update({"skip": skip, "limit": limit})
         try:
-            resp = requests.get(url, headers=elba_headers(), params=local_params, timeout=(10, 60))
-            resp.raise_for_status()
-            data = resp.json() or {}
-            # Попробуем разные ключи ответов
-            batch: List[Dict[str, Any]] = []
-            for key in item_keys:
-                if isinstance(data.get(key), list):
-                    batch = data.get(key)  # type: ignore[assignment]
-                    break
-            if not batch and isinstance(data, list):
-                batch = data  # иногда может прийти массив напрямую
-
-            items.extend(batch)
-            logger.debug(f"{url}: получено {len(batch)} (всего {len(items)})")
-            if len(batch) < limit:
-                break
-            skip += limit
-        except requests.exceptions.HTTPError as e:
-            status = getattr(e.response, "status_code", "?")
+            data = await elba_get(session, url, local_params) or {}
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
             logger.warning(f"{url}: HTTP {status}. Прерываю пагинацию: {e}")
-            break
+            return
         except Exception as e:
             logger.warning(f"{url}: ошибка запроса: {e}")
-            break
-
-    return items
+            return
 
+        batch = extract_items(data, item_keys)
+        total += len(batch)
+        logger.debug(f"{url}: получено {len(batch)} (всего {total})")
+        for item in batch:
+            yield item
+
+        # В режиме skip/limit курсор в ответах не используем, даже если появится
+        if use_cursor is None:
+            use_cursor = extract_cursor(data, cursor_keys) is not None
+        if use_cursor:
+            cursor = extract_cursor(data, cursor_keys)
+            if not cursor or not batch:
+                return
+            continue
+
+        if len(batch) < limit:
+            return
+        skip += limit
 
-def get_elba_counterparties(organization_id: str) -> List[Dict[str, Any]]:
-    """Пытаемся получить контрагентов по нескольким известным вариантам эндпоинтов."""
-    candidate_endpoints = [
-        f"{ELBA_API_BASE}/organizations/{organization_id}/counterparties",
-        f"{ELBA_API_BASE}/organizations/{organization_id}/contractors",
-        f"{ELBA_API_BASE}/counterparties",
-        f"{ELBA_API_BASE}/contractors",
-    ]
 
-    for endpoint in candidate_endpoints:
-        items = fetch_all_paginated(endpoint, {"limit": 100}, ["items", "counterparties", "contractors"])
-        if items:
-            logger.info(f"Контрагенты получены из {endpoint}: {len(items)}")
-            return items
-        logger.info(f"{endpoint} не вернул данные, пробуем следующий…")
+async def first_nonempty(coros: Iterable[Awaitable[Any]]) -> Optional[Tuple[int, Any]]:
+    """Запускает корутины параллельно и возвращает (индекс, результат) самой
+    приоритетной (с меньшим индексом) из вернувших непустой результат.
 
-    logger.error(
-        "Не удалось получить список контрагентов из Эльбы. Проверьте права токена и документацию."
+    Как только есть непустой результат, менее приоритетные корутины отменяются,
+    а более приоритетные дожидаемся.
+    """
+    tasks = {asyncio.ensure_future(coro): index for index, coro in enumerate(coros)}
+    pending = set(tasks)
+    results: Dict[int, Any] = {}
+    best: Optional[int] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result():
+                    results[tasks[task]] = task.result()
+            if results:
+                best = min(results)
+                for task in [t for t in pending if tasks[t] > best]:
+                    task.cancel()
+                    pending.discard(task)
+        return (best, results[best]) if best is not None else None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def probe_endpoint(
+    session: httpx.AsyncClient, url: str, item_keys: List[str]
+) -> Tuple[List[Dict[str, Any]], str]:
+    """Проверяет эндпоинт запросом одной записи. Возвращает (записи, статус), где
+    статус — "ok" (данные есть), "empty" (200 без данных), "not_found" (400/404)
+    или "error" (прочие ошибки)."""
+    try:
+        data = await elba_get(session, url, {"skip": 0, "limit": 1}) or {}
+    except httpx.HTTPStatusError as e:
+        status = e.response.status_code
+        logger.debug(f"{url}: проба вернула HTTP {status}")
+        return [], "not_found" if status in NOT_FOUND_STATUSES else "error"
+    except Exception as e:
+        logger.debug(f"{url}: проба не удалась: {e}")
+        return [], "error"
+    items = extract_items(data, item_keys)
+    return items, "ok" if items else "empty"
+
+
+def remember_endpoint(role: str, template: str, url: str) -> None:
+    if role not in _ENDPOINT_CACHE:
+        _ENDPOINT_CACHE[role] = template
+        logger.info(f"Эндпоинт для {role}: {url}")
+
+
+async def resolve_endpoint(
+    session: httpx.AsyncClient,
+    role: str,
+    templates: Tuple[str, ...],
+    item_keys: List[str],
+    **fmt: str,
+) -> Optional[str]:
+    """Возвращает URL рабочего эндпоинта для роли: из кеша или по результатам
+    параллельной пробы всех вариантов для этого вызова.
+
+    Пока эндпоинт не определён, пробуют не более ENDPOINT_PROBE_CONCURRENCY
+    контрагентов одновременно. Ответ 400/404 отбрасывает вариант только для
+    текущего вызова: у многих API так выглядит «у контрагента нет контактов».
+    """
+    if role not in _ENDPOINT_CACHE:
+        sem = _ENDPOINT_PROBE_SEMAPHORES.setdefault(
+            role, asyncio.Semaphore(ENDPOINT_PROBE_CONCURRENCY)
+        )
+        async with sem:
+            if role not in _ENDPOINT_CACHE:
+                return await probe_for_endpoint(session, role, templates, item_keys, **fmt)
+    return _ENDPOINT_CACHE[role].format(base=ELBA_API_BASE, **fmt)
+
+
+async def probe_for_endpoint(
+    session: httpx.AsyncClient,
+    role: str,
+    templates: Tuple[str, ...],
+    item_keys: List[str],
+    **fmt: str,
+) -> Optional[str]:
+    urls = [t.format(base=ELBA_API_BASE, **fmt) for t in templates]
+    statuses: Dict[int, str] = {}
+
+    async def probe(index: int) -> List[Dict[str, Any]]:
+        items, statuses[index] = await probe_endpoint(session, urls[index], item_keys)
+        return items
+
+    winner = await first_nonempty(probe(index) for index in range(len(urls)))
+    if winner is not None:
+        index = winner[0]
+        remember_endpoint(role, templates[index], urls[index])
+        return urls[index]
+
+    # Данных нет ни у одного варианта. Если ровно один ответил 200, а остальные
+    # для этого же контрагента — 400/404, то рабочий эндпоинт всё равно найден.
+    # Иначе ничего не запоминаем: следующий контрагент пробует все варианты заново.
+    empty = [i for i, status in statuses.items() if status == "empty"]
+    not_found = [i for i, status in statuses.items() if status == "not_found"]
+    if len(empty) == 1 and len(empty) + len(not_found) == len(urls):
+        remember_endpoint(role, templates[empty[0]], urls[empty[0]])
+        return urls[empty[0]]
+    return None
+
+
+async def get_elba_counterparties(
+    session: httpx.AsyncClient, organization_id: str
+) -> AsyncIterator[Dict[str, Any]]:
+    """Отдаём контрагентов по мере загрузки из первого сработавшего эндпоинта."""
+    endpoint = await resolve_endpoint(
+        session, "counterparties", COUNTERPARTY_ENDPOINTS, COUNTERPARTY_ITEM_KEYS,
+        org_id=organization_id,
     )
-    return []
+    if not endpoint:
+        logger.error(
+            "Не удалось получить список контрагентов из Эльбы. Проверьте права токена и документацию."
+        )
+        return
 
+    logger.info(f"Контрагенты загружаются из {endpoint}")
+    async for item in iter_paginated(session, endpoint, {"limit": 100}, COUNTERPARTY_ITEM_KEYS):
+        yield item
 
-def get_elba_contacts_for_counterparty(organization_id: str, counterparty_id: str) -> List[Dict[str, Any]]:
-    """Пробуем несколько вариантов эндпоинтов для контактных лиц контрагента."""
-    candidates = [
-        f"{ELBA_API_BASE}/organizations/{organization_id}/counterparties/{counterparty_id}/contacts",
-        f"{ELBA_API_BASE}/organizations/{organization_id}/contractors/{counterparty_id}/contacts",
-        f"{ELBA_API_BASE}/counterparties/{counterparty_id}/contacts",
-        f"{ELBA_API_BASE}/contractors/{counterparty_id}/contacts",
-    ]
 
-    for url in candidates:
-        contacts = fetch_all_paginated(url, {"limit": 100}, ["items", "contacts"])
-        if contacts:
-            return contacts
-    return []
+async def get_elba_contacts_for_counterparty(
+    session: httpx.AsyncClient, organization_id: str, counterparty_id: str
+) -> List[Dict[str, Any]]:
+    """Контактные лица контрагента по первому сработавшему варианту эндпоинта."""
+    url = await resolve_endpoint(
+        session, "contacts", CONTACT_ENDPOINTS, CONTACT_ITEM_KEYS,
+        org_id=organization_id, cp_id=counterparty_id,
+    )
+    if not url:
+        return []
+    return [item async for item in iter_paginated(session, url, {"limit": 100}, CONTACT_ITEM_KEYS)]
 
 
 # ----------------------------- Маппинг в Bitrix24 ------------------------------
 
-def map_company_fields_from_cp(cp: Dict[str, Any]) -> Dict[str, Any]:
+def map_company_fields_from_cp(cp: Dict[str, Any], cp_elba_id: str) -> Dict[str, Any]:
     title = cp.get("shortName") or cp.get("name") or cp.get("inn") or "Без названия"
     fields: Dict[str, Any] = {
         "TITLE": title,
-        "UF_CRM_ELBA_ID": str(cp.get("id") or cp.get("counterpartyId") or cp.get("contractorId") or ""),
+        "UF_CRM_ELBA_ID": cp_elba_id,
     }
 
     inn = cp.get("inn") or cp.get("INN")
@@ -260,12 +597,13 @@ def map_company_fields_from_cp(cp: Dict[str, Any]) -> Dict[str, Any]:
     return fields
 
 
-def map_contact_fields_from_person(person: Dict[str, Any], cp: Dict[str, Any]) -> Dict[str, Any]:
+def map_contact_fields_from_person(person: Dict[str, Any], uniq: str) -> Dict[str, Any]:
+    """uniq — составной ключ "<ЭльбаID контрагента>:<ID контакта в Эльбе>"."""
     full_name = (
         person.get("fullName")
         or person.get("fio")
         or person.get("name")
-        or f"Контакт {person.get('id') or ''}"
+        or f"Контакт {person.get('_elba_id') or ''}"
     )
     last_name, first_name, second_name = extract_name_parts(full_name)
 
@@ -274,7 +612,7 @@ def map_contact_fields_from_person(person: Dict[str, Any], cp: Dict[str, Any]) -
         "NAME": first_name,
         "SECOND_NAME": second_name,
         # Уникальность контакта — по связке ЭльбаID контрагента + ID контакта в Эльбе
-        "UF_CRM_ELBA_ID": f"{str(cp.get('id') or cp.get('counterpartyId') or cp.get('contractorId') or '')}:{str(person.get('id') or '')}",
+        "UF_CRM_ELBA_ID": uniq,
     }
 
     phone = person.get("phone") or person.get("phoneNumber")
@@ -290,22 +628,35 @@ def map_contact_fields_from_person(person: Dict[str, Any], cp: Dict[str, Any]) -
 
 # ------------------------ Поиск существующих в Bitrix24 -----------------------
 
-def find_existing_by_elba_ids(entity_type: str, elba_ids: List[str]) -> Dict[str, str]:
+async def find_existing_by_elba_ids(
+    session: httpx.AsyncClient, entity_type: str, elba_ids: List[str]
+) -> Dict[str, str]:
     """Возвращает мапу elba_id -> bitrix_id для уже существующих сущностей."""
+    # Эльба может вернуть дубли — лишние ID только раздувают число запросов
+    elba_ids = list(dict.fromkeys(eid for eid in elba_ids if eid))
     if not elba_ids:
         return {}
     method = f"crm.{entity_type}.list"
     result: Dict[str, str] = {}
-
-    # Bitrix ограничивает размер страницы; пройдемся чанками
-    for group in chunked(elba_ids, 50):
-        res = bitrix_call(
-            method,
-            {
-                "filter": {"UF_CRM_ELBA_ID": [str(x) for x in group]},
-                "select": ["ID", "UF_CRM_ELBA_ID"],
-            },
-        ) or []
+    sem = asyncio.Semaphore(LOOKUP_CONCURRENCY)
+
+    async def lookup_group(group: List[str]) -> List[Dict[str, Any]]:
+        async with sem:
+            return await bitrix_call(
+                session,
+                method,
+                {
+                    "filter": {"UF_CRM_ELBA_ID": [str(x) for x in group]},
+                    "select": ["ID", "UF_CRM_ELBA_ID"],
+                    "order": {"ID": "ASC"},
+                    # Без подсчёта общего количества — меньше работы на стороне Bitrix
+                    "start": -1,
+                },
+            ) or []
+
+    # Bitrix ограничивает размер страницы; пройдемся чанками, запросы — параллельно
+    groups = await asyncio.gather(*[lookup_group(group) for group in chunked(elba_ids, 50)])
+    for res in groups:
         for row in res:
             key = str(row.get("UF_CRM_ELBA_ID"))
             if key:
@@ -316,95 +667,236 @@ def find_existing_by_elba_ids(entity_type: str, elba_ids: List[str]) -> Dict[str
 
 # --------------------------------- Создание -----------------------------------
 
-def create_company(fields: Dict[str, Any]) -> str:
-    return str(bitrix_call("crm.company.add", {"fields": fields}))
+async def create_entities(
+    session: httpx.AsyncClient,
+    entity_type: str,
+    entities: List[Tuple[str, Dict[str, Any]]],
+) -> Dict[str, str]:
+    """Создаёт сущности пачками через batch. Принимает пары (elba_id, fields),
+    возвращает мапу elba_id -> bitrix_id для успешно созданных."""
+    method = f"crm.{entity_type}.add"
+
+    async def create_group(group: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, str]:
+        created: Dict[str, str] = {}
+        for attempt in range(BITRIX_ATTEMPTS):
+            cmds = {
+                f"{entity_type}_add_{index}": build_batch_command(method, {"fields": fields})
+                for index, (_, fields) in enumerate(group)
+            }
+            try:
+                # Сам batch не повторяем: после таймаута или 5xx Bitrix мог уже
+                # создать сущности, и повтор создал бы их второй раз
+                results = await bitrix_batch(session, cmds, retry=False)
+            except httpx.HTTPError as e:
+                if attempt == BITRIX_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"Bitrix24 batch {method}: {e}. Проверяю, что уже создано…")
+                await asyncio.sleep(min(4 * 2 ** attempt, 10))
+                # Перед повтором отправляем только то, чего в Bitrix24 ещё нет
+                existing = await find_existing_by_elba_ids(
+                    session, entity_type, [elba_id for elba_id, _ in group]
+                )
+                created.update(existing)
+                group = [(elba_id, fields) for elba_id, fields in group if elba_id not in existing]
+                if not group:
+                    break
+                continue
 
+            for index, (elba_id, _) in enumerate(group):
+                bitrix_id = results.get(f"{entity_type}_add_{index}")
+                if bitrix_id:
+                    created[elba_id] = str(bitrix_id)
+            break
+        return created
 
-def create_contact(fields: Dict[str, Any]) -> str:
-    return str(bitrix_call("crm.contact.add", {"fields": fields}))
+    result: Dict[str, str] = {}
+    for created in await asyncio.gather(
+        *[create_group(group) for group in chunked(entities, BITRIX_BATCH_SIZE)]
+    ):
+        result.update(created)
+    return result
 
 
 # -------------------------------- Основной ход --------------------------------
 
-def main() -> None:
-    try:
-        logger.info("Проверяю пользовательские поля в Bitrix24…")
-        ensure_userfields()
+def inline_persons(cp: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Контактные лица, пришедшие прямо в карточке контрагента."""
+    for key in ("contacts", "contactPersons", "persons"):
+        if isinstance(cp.get(key), list) and cp.get(key):
+            return cp.get(key)  # type: ignore[return-value]
+    return []
 
-        logger.info("Получаю organizationId в Эльбе…")
-        org_id = get_organization_id()
-        logger.info(f"organizationId: {org_id}")
 
-        logger.info("Запрашиваю контрагентов из Эльбы…")
-        counterparties = get_elba_counterparties(org_id)
-        logger.info(f"Получено контрагентов: {len(counterparties)}")
-        if not counterparties:
-            return
+async def fetch_cp_persons(
+    session: httpx.AsyncClient, org_id: str, cp_elba_id: str
+) -> Tuple[str, List[Dict[str, Any]]]:
+    return cp_elba_id, await get_elba_contacts_for_counterparty(session, org_id, cp_elba_id)
+
+
+async def sync_counterparties(
+    elba_session: httpx.AsyncClient,
+    bitrix_session: httpx.AsyncClient,
+    org_id: str,
+    counterparties: Dict[str, Dict[str, Any]],
+) -> int:
+    """Синхронизирует пачку контрагентов (elba_id -> cp): компании, затем контакты.
+
+    Возвращает число сущностей, которые не удалось создать (включая контакты,
+    пропущенные из-за несозданной компании).
+    """
+    failed = 0
+    # Контактные лица, которых нет в карточке, запрашиваем из Эльбы заранее и
+    # параллельно (число одновременных HTTP-запросов ограничено HTTP_SEMAPHORE),
+    # пока в Bitrix24 идёт работа с компаниями
+    needs_fetch = [cp_elba_id for cp_elba_id, cp in counterparties.items() if not inline_persons(cp)]
+    prefetch = asyncio.ensure_future(
+        asyncio.gather(*[fetch_cp_persons(elba_session, org_id, cp_elba_id) for cp_elba_id in needs_fetch])
+    )
 
-        # Идентификаторы для компаний
-        company_elba_ids: List[str] = [
-            str(cp.get("id") or cp.get("counterpartyId") or cp.get("contractorId") or "")
-            for cp in counterparties
+    try:
+        # Компании: ищем имеющиеся, недостающие создаём пачками через batch
+        company_elba_ids: List[str] = list(counterparties)
+        existing_companies = await find_existing_by_elba_ids(bitrix_session, "company", company_elba_ids)
+        new_companies = [
+            (cp_elba_id, map_company_fields_from_cp(cp, cp_elba_id))
+            for cp_elba_id, cp in counterparties.items()
+            if cp_elba_id not in existing_companies
         ]
-        company_elba_ids = [eid for eid in company_elba_ids if eid]
-        existing_companies = find_existing_by_elba_ids("company", company_elba_ids)
-
-        # Итерируем контрагентов, создаём компании и контактные лица
-        for cp in tqdm(counterparties, desc="Синхронизация компаний и контактов"):
-            cp_elba_id = str(
-                cp.get("id") or cp.get("counterpartyId") or cp.get("contractorId") or ""
-            )
-            if not cp_elba_id:
-                logger.warning("Пропуск контрагента без ID")
-                continue
-
-            # Компания
-            company_id: Optional[str] = existing_companies.get(cp_elba_id)
-            if company_id:
-                logger.debug(f"Компания уже существует Elba={cp_elba_id} → Bitrix={company_id}")
-            else:
-                company_fields = map_company_fields_from_cp(cp)
-                company_id = create_company(company_fields)
-                existing_companies[cp_elba_id] = company_id
+        if new_companies:
+            created_companies = await create_entities(bitrix_session, "company", new_companies)
+            for cp_elba_id, company_id in created_companies.items():
                 logger.info(f"Создана компания Bitrix ID={company_id} для Elba={cp_elba_id}")
+            existing_companies.update(created_companies)
+            failed += len(new_companies) - len(created_companies)
+    except BaseException:
+        prefetch.cancel()
+        raise
 
-            # Контактные лица
-            persons = []
-            # 1) Явный список в карточке
-            for key in ("contacts", "contactPersons", "persons"):
-                if isinstance(cp.get(key), list) and cp.get(key):
-                    persons = cp.get(key)  # type: ignore[assignment]
-                    break
-            # 2) Отдельный запрос, если внутри нет
-            if not persons:
-                persons = get_elba_contacts_for_counterparty(org_id, cp_elba_id)
-
-            if not persons:
-                continue
-
-            # Соберём ID для поиска имеющихся контактов
-            contact_elba_ids = [
-                f"{cp_elba_id}:{str(p.get('id') or p.get('personId') or '')}"
-                for p in persons
-                if (p.get("id") or p.get("personId"))
-            ]
-            existing_contacts = find_existing_by_elba_ids("contact", contact_elba_ids)
-
-            for person in persons:
-                pid = str(person.get("id") or person.get("personId") or "")
-                if not pid:
-                    continue
-                uniq = f"{cp_elba_id}:{pid}"
-                if uniq in existing_contacts:
-                    logger.debug(f"Контакт уже существует Elba={uniq} → Bitrix={existing_contacts[uniq]}")
-                    continue
-
-                contact_fields = map_contact_fields_from_person(person, cp)
-                # Привяжем к компании
-                if company_id:
-                    contact_fields["COMPANY_ID"] = company_id
-                cid = create_contact(contact_fields)
-                logger.info(f"Создан контакт Bitrix ID={cid} для Elba={uniq}")
+    contacts_by_cp: Dict[str, List[Dict[str, Any]]] = dict(await prefetch)
+
+    # Составной ключ контакта строим один раз: ключ -> (ЭльбаID контрагента, контакт).
+    # Повторы одного контакта отбрасываем, иначе он будет создан дважды.
+    all_persons: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    for cp_elba_id, cp in counterparties.items():
+        persons = contacts_by_cp.get(cp_elba_id) or inline_persons(cp)
+        if not persons:
+            continue
+        for person in persons:
+            # ID контакта вычисляем один раз и дальше читаем из person["_elba_id"]
+            person["_elba_id"] = str(person.get("id") or person.get("personId") or "")
+            if person["_elba_id"]:
+                all_persons.setdefault(f"{cp_elba_id}:{person['_elba_id']}", (cp_elba_id, person))
+    # Контактов с ID нет — не ходим в Bitrix24 вовсе: пустой фильтр crm.contact.list
+    # вернул бы все контакты подряд
+    if not all_persons:
+        return failed
+
+    # Один общий поиск имеющихся контактов на пачку вместо запроса на каждого контрагента
+    all_contact_keys = list(all_persons)
+    existing_contacts = await find_existing_by_elba_ids(bitrix_session, "contact", all_contact_keys)
+
+    new_contacts: List[Tuple[str, Dict[str, Any]]] = []
+    for uniq, (cp_elba_id, person) in all_persons.items():
+        if uniq in existing_contacts:
+            logger.debug(f"Контакт уже существует Elba={uniq} → Bitrix={existing_contacts[uniq]}")
+            continue
+
+        # Без компании контакт не создаём: иначе он останется непривязанным,
+        # а при следующем запуске уже будет считаться существующим
+        company_id = existing_companies.get(cp_elba_id)
+        if not company_id:
+            logger.warning(f"Пропуск контакта Elba={uniq}: компания Elba={cp_elba_id} не создана")
+            failed += 1
+            continue
+
+        contact_fields = map_contact_fields_from_person(person, uniq)
+        # Привяжем к компании
+        contact_fields["COMPANY_ID"] = company_id
+        new_contacts.append((uniq, contact_fields))
+
+    if new_contacts:
+        created_contacts = await create_entities(bitrix_session, "contact", new_contacts)
+        for uniq, cid in created_contacts.items():
+            logger.info(f"Создан контакт Bitrix ID={cid} для Elba={uniq}")
+        failed += len(new_contacts) - len(created_contacts)
+    return failed
+
+
+async def main(force_check_userfields: bool = False) -> None:
+    reset_run_state()
+    try:
+        async with create_http_session(elba_headers()) as elba_session, \
+                create_http_session() as bitrix_session:
+            logger.info("Проверяю пользовательские поля в Bitrix24…")
+            await ensure_userfields(bitrix_session, force=force_check_userfields)
+
+            logger.info("Получаю organizationId в Эльбе…")
+            org_id = await get_organization_id(elba_session)
+            logger.info(f"organizationId: {org_id}")
+
+            logger.info("Запрашиваю контрагентов из Эльбы…")
+            queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(maxsize=SYNC_QUEUE_SIZE)
+            # Прогресс обновляется раз на пачку, а терминал перерисовывается не чаще
+            # раза в полсекунды, чтобы вывод не тормозил обработку
+            progress = atqdm(
+                desc="Синхронизация компаний и контактов", unit="контрагент", mininterval=0.5
+            )
+            received = 0
+            failed = 0
+
+            async def produce() -> None:
+                nonlocal received
+                # Дубли по ID отбрасываем сразу, иначе одна компания будет создана дважды
+                processed: Set[str] = set()
+                async for cp in get_elba_counterparties(elba_session, org_id):
+                    received += 1
+                    # ID контрагента вычисляем один раз и дальше читаем из cp["_elba_id"]
+                    cp["_elba_id"] = str(
+                        cp.get("id") or cp.get("counterpartyId") or cp.get("contractorId") or ""
+                    )
+                    if not cp["_elba_id"]:
+                        logger.warning("Пропуск контрагента без ID")
+                        continue
+                    if cp["_elba_id"] in processed:
+                        continue
+                    processed.add(cp["_elba_id"])
+                    await queue.put(cp)
+                for _ in range(SYNC_WORKERS):
+                    await queue.put(None)
+
+            async def consume() -> None:
+                nonlocal failed
+                finished = False
+                while not finished:
+                    chunk: Dict[str, Dict[str, Any]] = {}
+                    while len(chunk) < BITRIX_BATCH_SIZE:
+                        cp = await queue.get()
+                        if cp is None:
+                            finished = True
+                            break
+                        chunk[cp["_elba_id"]] = cp
+                    if chunk:
+                        chunk_failed = await sync_counterparties(
+                            elba_session, bitrix_session, org_id, chunk
+                        )
+                        failed += chunk_failed
+                        progress.update(len(chunk))
+
+            tasks = [asyncio.ensure_future(produce())]
+            tasks += [asyncio.ensure_future(consume()) for _ in range(SYNC_WORKERS)]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            finally:
+                progress.close()
+            logger.info(f"Получено контрагентов: {received}")
+            if failed:
+                raise RuntimeError(
+                    f"Не удалось создать в Bitrix24 сущностей: {failed} (подробности выше в логе)"
+                )
 
         logger.info("Синхронизация завершена")
 
@@ -413,5 +905,16 @@ def main() -> None:
         raise
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Синхронизация контрагентов Эльбы в Bitrix24")
+    parser.add_argument(
+        "--force-check-userfields",
+        action="store_true",
+        help="проверить пользовательские поля в Bitrix24, даже если это уже делалось",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    asyncio.run(main(force_check_userfields=args.force_check_userfields))